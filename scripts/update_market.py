@@ -1,9 +1,14 @@
-import json
-import re
-from datetime import datetime, timezone
+import bisect
+import csv
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
-import requests
+import orjson
 
 MARKET_PATH = Path("data/market.json")
 
@@ -23,9 +28,70 @@ HEADERS = {
     "Connection": "keep-alive",
 }
 
-
-def utc_now_iso():
-    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+# Lazy: requests trækker urllib3/certifi/charset_normalizer/idna med sig,
+# og på weekend/cache-hit runs rører vi slet ikke netværket — så importen
+# (og session-opbygningen) udskydes til første rigtige fetch.
+_SESSION = None
+
+
+def get_session():
+    """Én delt session med connection pooling: keep-alive genbruger
+    TLS-forbindelsen på CNN's JSON->HTML fallback, og Retry håndterer
+    flaky 5xx/429 fra FRED. Bygges først når der faktisk skal fetches."""
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        s = requests.Session()
+        s.headers.update(HEADERS)
+        s.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=4,
+                max_retries=Retry(
+                    total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]
+                ),
+            ),
+        )
+        _SESSION = s
+    return _SESSION
+
+
+# Kompileres først hvis HTML-fallbacken overhovedet rammes (samme lazy-logik)
+_FNG_RE = None
+
+
+def _get_fng_re():
+    """Ét samlet (prækompileret) mønster i stedet for 4 separate re.search-kald,
+    så HTML'en kun scannes én gang. De bundne {0,N}-kvantorer holder
+    backtracking lineær i stedet for .*?'s vilde gæt. Bytes-regex, så vi
+    slipper for utf-8 -> UCS-4 dekodning af hele bodyen."""
+    global _FNG_RE
+    if _FNG_RE is None:
+        import re
+
+        _FNG_RE = re.compile(
+            rb'(?:"fear(?:_and_|And)[gG]reed"\s*:\s*\{[^{}]{0,4096}?"now"\s*:\s*\{[^}]{0,256}?"value"\s*:\s*(\d{1,3}))'
+            rb'|(?:"now"\s*:\s*\{[^}]{0,256}?"value"\s*:\s*(\d{1,3}))'
+            rb'|(?:"score"\s*:\s*(\d{1,3}))',
+            re.IGNORECASE,
+        )
+    return _FNG_RE
+
+
+# Værdien står i et inline <script> nær toppen af dokumentet — scan kun prefixet.
+_HTML_SCAN_CAP = 262144
+
+
+def last_business_day_iso(now_et):
+    """Seneste hverdag (man-fre) i New York. US-helligdage håndteres ikke."""
+    d = now_et.date()
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d.isoformat()
 
 
 def safe_float(x):
@@ -52,22 +118,27 @@ def safe_int_0_100(x):
     return None
 
 
-def fetch_json(url, timeout=25):
-    r = requests.get(url, timeout=timeout, headers=HEADERS)
-    r.raise_for_status()
-    return r.json()
+def conditional_headers(prev):
+    """If-None-Match/If-Modified-Since fra sidste succesfulde fetch (hvis gemt)."""
+    h = {}
+    if isinstance(prev, dict):
+        if prev.get("etag"):
+            h["If-None-Match"] = prev["etag"]
+        if prev.get("lastModified"):
+            h["If-Modified-Since"] = prev["lastModified"]
+    return h
 
 
-def fetch_text(url, timeout=25):
-    r = requests.get(url, timeout=timeout, headers=HEADERS)
+def fetch_bytes(url, timeout=25, cap=None):
+    r = get_session().get(url, timeout=timeout)
     r.raise_for_status()
-    return r.text
+    return r.content if cap is None else r.content[:cap]
 
 
 def load_existing_market():
     if MARKET_PATH.exists():
         try:
-            return json.loads(MARKET_PATH.read_text(encoding="utf-8"))
+            return orjson.loads(MARKET_PATH.read_bytes())
         except Exception:
             pass
 
@@ -80,38 +151,60 @@ def load_existing_market():
     }
 
 
+def _digest(d):
+    """Hash af de meningsbærende felter — updatedAt/notes tæller ikke med."""
+    if not isinstance(d, dict):
+        return None
+    return hashlib.blake2b(
+        orjson.dumps({k: d.get(k) for k in ("fearGreed", "vix")}, option=orjson.OPT_SORT_KEYS),
+        digest_size=16,
+    ).hexdigest()
+
+
+# simple bins: 0-24, 25-44, 45-54, 55-74, 75-100
+_FNG_LABELS = ("Ekstrem frygt", "Frygt", "Neutral", "Grådighed", "Ekstrem grådighed")
+_FNG_BOUNDS = (25, 45, 55, 75)
+
+
 def label_fng(v):
     if v is None:
         return None
-    # simple bins
-    if v <= 24:
-        return "Ekstrem frygt"
-    if v <= 44:
-        return "Frygt"
-    if v <= 54:
-        return "Neutral"
-    if v <= 74:
-        return "Grådighed"
-    return "Ekstrem grådighed"
-
-
-def _walk_find_numbers(obj):
-    """Find alle tal-lignende værdier dybt i JSON (som floats)."""
-    nums = []
+    return _FNG_LABELS[bisect.bisect_right(_FNG_BOUNDS, v)]
+
+
+# Kendte stier til index-værdien i CNN graphdata, i prioriteret rækkefølge.
+# Prøves før det generiske tree-walk — rammer i praksis altid.
+_FNG_PATHS = (
+    ("fear_and_greed", "score"),
+    ("fear_and_greed", "now", "value"),
+    ("fear_and_greed", "now", "score"),
+    ("fear_and_greed_historical", "data", -1, "y"),
+)
+
+
+def _dig(obj, path):
+    """Slå en nøgle/indeks-sti op i nested JSON; None hvis stien ikke findes."""
+    for key in path:
+        try:
+            obj = obj[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return obj
+
+
+def _walk_numbers(obj):
+    """Yield tal-lignende værdier dybt i JSON (som floats), én ad gangen."""
     stack = [obj]
     while stack:
         cur = stack.pop()
         if isinstance(cur, dict):
-            for k, v in cur.items():
-                # gem både key og value, så vi kan spotte mønstre
-                stack.append(v)
+            stack.extend(cur.values())
         elif isinstance(cur, list):
             stack.extend(cur)
         else:
             fv = safe_float(cur)
             if fv is not None:
-                nums.append(fv)
-    return nums
+                yield fv
 
 
 def _find_fng_from_graph_json(payload):
@@ -122,6 +215,12 @@ def _find_fng_from_graph_json(payload):
     - noget der hedder fear_and_greed / fearAndGreed og indeholder en "now"
     - fallback: find et heltal 0-100 som "ligner" et index (sidste udvej)
     """
+    # 0) Kendte JSON-stier først — sparer hele tree-walket i det normale tilfælde
+    for path in _FNG_PATHS:
+        v = safe_int_0_100(_dig(payload, path))
+        if v is not None:
+            return v
+
     # 1) Generic: find dict med now -> { value/score }
     stack = [payload]
     while stack:
@@ -158,28 +257,34 @@ def _find_fng_from_graph_json(payload):
                 if v is not None:
                     return v
 
-    # 3) Last resort: scan alle tal og find et heltal 0-100 (men undgå fx years/dates)
-    nums = _walk_find_numbers(payload)
-    candidates = [int(round(x)) for x in nums if 0 <= x <= 100]
-    # typisk er index et heltal — vi tager det mest "heltals-agtige"
-    for c in candidates:
-        if 0 <= c <= 100:
-            return c
+    # 3) Last resort: scan tallene lazily og stop ved første heltal 0-100,
+    # så historiske arrays aldrig materialiseres som én stor liste
+    for x in _walk_numbers(payload):
+        if 0 <= x <= 100 and float(int(round(x))) == x:
+            return int(round(x))
 
     return None
 
 
-def fetch_fng_best_effort(notes):
+def fetch_fng_best_effort(notes, prev, today_iso):
     # A) Graph JSON
     try:
-        payload = fetch_json(CNN_GRAPH_URL)
+        r = get_session().get(CNN_GRAPH_URL, timeout=25, headers=conditional_headers(prev))
+        if r.status_code == 304 and isinstance(prev, dict) and prev.get("value") is not None:
+            # Uændret siden sidst — genbrug sidste kendte værdi uden at parse.
+            return prev
+        r.raise_for_status()
+        # orjson læser bytes direkte — sparer decode + den langsommere stdlib-parser
+        payload = orjson.loads(r.content)
         v = _find_fng_from_graph_json(payload)
         if v is not None:
             return {
                 "value": v,
                 "label": label_fng(v),
-                "asof": datetime.now(timezone.utc).date().isoformat(),
+                "asof": today_iso,
                 "source": "CNN (graphdata)",
+                "etag": r.headers.get("ETag"),
+                "lastModified": r.headers.get("Last-Modified"),
             }
         notes.append("Fear&Greed: kunne ikke finde 0-100 i CNN graphdata.")
     except Exception as e:
@@ -187,26 +292,19 @@ def fetch_fng_best_effort(notes):
 
     # B) HTML side (regex)
     try:
-        html = fetch_text(CNN_PAGE_URL)
-        # Prøv et par typiske mønstre: "fearAndGreed":{... "now":{..."value": 62 ...}}
-        patterns = [
-            r'"fearAndGreed"\s*:\s*\{.*?"now"\s*:\s*\{.*?"value"\s*:\s*(\d{1,3})',
-            r'"fear_and_greed"\s*:\s*\{.*?"now"\s*:\s*\{.*?"value"\s*:\s*(\d{1,3})',
-            r'"now"\s*:\s*\{[^}]*?"value"\s*:\s*(\d{1,3})',
-            # nogle gange bare "score": 62
-            r'"score"\s*:\s*(\d{1,3})',
-        ]
-        for p in patterns:
-            m = re.search(p, html, flags=re.IGNORECASE | re.DOTALL)
-            if m:
-                v = safe_int_0_100(m.group(1))
-                if v is not None:
-                    return {
-                        "value": v,
-                        "label": label_fng(v),
-                        "asof": datetime.now(timezone.utc).date().isoformat(),
-                        "source": "CNN (page)",
-                    }
+        html = fetch_bytes(CNN_PAGE_URL, cap=_HTML_SCAN_CAP)
+        # Matcher "fearAndGreed"/"fear_and_greed" -> now -> value, bare "now" -> value,
+        # eller nogle gange bare "score": 62 — i én scanning.
+        m = _get_fng_re().search(html)
+        if m:
+            v = safe_int_0_100(next(g for g in m.groups() if g is not None).decode("ascii"))
+            if v is not None:
+                return {
+                    "value": v,
+                    "label": label_fng(v),
+                    "asof": today_iso,
+                    "source": "CNN (page)",
+                }
         notes.append("Fear&Greed: kunne ikke extracte fra CNN page (regex).")
     except Exception as e:
         notes.append(f"Fear&Greed page failed: {type(e).__name__}: {e}")
@@ -214,25 +312,40 @@ def fetch_fng_best_effort(notes):
     return None
 
 
-def fetch_vix_from_fred(notes):
+def fetch_vix_from_fred(notes, prev=None):
     try:
-        csv_text = fetch_text(FRED_VIX_CSV)
-        lines = [ln.strip() for ln in csv_text.splitlines() if ln.strip()]
-        # header: DATE,VIXCLS
-        # find sidste gyldige datapunkt bagfra
         last_date, last_val = None, None
-        for ln in reversed(lines[1:]):
-            parts = ln.split(",")
-            if len(parts) >= 2:
-                d, v = parts[0], parts[1]
-                fv = safe_float(v)
-                if fv is not None:
-                    last_date, last_val = d, fv
-                    break
+        etag, last_modified = None, None
+        with get_session().get(
+            FRED_VIX_CSV, timeout=25, headers=conditional_headers(prev), stream=True
+        ) as r:
+            if r.status_code == 304 and isinstance(prev, dict) and prev.get("value") is not None:
+                # CSV'en er uændret — spring download+parse helt over.
+                return prev
+            r.raise_for_status()
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            # header: DATE,VIXCLS — stream rækkerne gennem C-implementeret
+            # csv.reader og husk kun sidste gyldige datapunkt (deque maxlen=1),
+            # så hele filen aldrig ligger i hukommelsen.
+            reader = csv.reader(r.iter_lines(decode_unicode=True))
+            next(reader, None)  # skip header
+            last = deque(maxlen=1)
+            for row in reader:
+                if len(row) >= 2 and safe_float(row[1]) is not None:
+                    last.append(row)
+            if last:
+                last_date, last_val = last[0][0].strip(), float(last[0][1])
         if last_val is None:
             notes.append("VIX: ingen gyldig værdi i FRED CSV.")
             return None
-        return {"value": round(last_val, 2), "asof": last_date, "source": "FRED (VIXCLS)"}
+        return {
+            "value": round(last_val, 2),
+            "asof": last_date,
+            "source": "FRED (VIXCLS)",
+            "etag": etag,
+            "lastModified": last_modified,
+        }
     except Exception as e:
         notes.append(f"VIX failed: {type(e).__name__}: {e}")
         return None
@@ -240,20 +353,43 @@ def fetch_vix_from_fred(notes):
 
 def main():
     existing = load_existing_market()
+    # Snapshot før vi muterer `existing` nedenfor (out peger på samme dict)
+    old_digest = _digest(existing)
+
+    # Ét klokkeslæt-snapshot for hele runnet: updatedAt, asof og weekend-
+    # checket er garanteret enige om "nu", også hen over midnat.
+    now = datetime.now(timezone.utc)
+    updated_at = now.replace(microsecond=0).isoformat()
+    today_iso = now.date().isoformat()
 
     # vi skriver vores egne noter for denne run (max 6 linjer for ikke at spamme)
     run_notes = []
 
     out = existing if isinstance(existing, dict) else {}
-    out["updatedAt"] = utc_now_iso()
+    out["updatedAt"] = updated_at
 
     # Sørg for structure
     out.setdefault("fearGreed", {"value": None, "label": None, "asof": None, "source": None})
     out.setdefault("vix", {"value": None, "asof": None, "source": None})
     out.setdefault("notes", [])
 
+    # Weekend-genvej: F&G og VIXCLS er daglige serier, så på lør/søn (ET) kan
+    # værdien beviseligt ikke have ændret sig siden fredagslukket. Har vi
+    # allerede fredagens datapunkt, springer vi begge HTTPS-fetches over.
+    now_et = now.astimezone(ZoneInfo("America/New_York"))
+    if now_et.weekday() >= 5 and (out.get("vix") or {}).get("asof") == last_business_day_iso(now_et):
+        # Intet ændret — og ingen skrivning betyder ingen git-diff/commit i CI
+        print(f"{MARKET_PATH} uændret (weekend) — skriver ikke")
+        return
+
+    # --- Hent begge kilder parallelt (uafhængig netværks-I/O) ---
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fng_future = ex.submit(fetch_fng_best_effort, run_notes, out.get("fearGreed"), today_iso)
+        vix_future = ex.submit(fetch_vix_from_fred, run_notes, out.get("vix"))
+        fng = fng_future.result()
+        vix = vix_future.result()
+
     # --- Fear & Greed (BEST EFFORT) ---
-    fng = fetch_fng_best_effort(run_notes)
     if fng is not None and fng.get("value") is not None:
         out["fearGreed"] = fng
     else:
@@ -265,7 +401,6 @@ def main():
             run_notes.append("Fear&Greed: fetch fejlede, beholdt sidste kendte værdi.")
 
     # --- VIX (stabil) ---
-    vix = fetch_vix_from_fred(run_notes)
     if vix is not None and vix.get("value") is not None:
         out["vix"] = vix
     else:
@@ -282,9 +417,20 @@ def main():
     run_notes = run_notes[:6]
     out["notes"] = merged_notes + run_notes
 
-    # Write
+    # Skriv kun hvis de meningsbærende felter faktisk har ændret sig —
+    # ellers laver CI-workflowet en commit for hver eneste run.
+    if MARKET_PATH.exists() and _digest(out) == old_digest:
+        print(f"{MARKET_PATH} uændret — skriver ikke")
+        return
+
+    # Write — atomisk via tmp-fil + os.replace, så en læser (eller et crash
+    # midt i skrivningen) aldrig ser en halv/ugyldig JSON og dermed smider
+    # den cachede etag/sidst-kendte værdi væk.
     MARKET_PATH.parent.mkdir(parents=True, exist_ok=True)
-    MARKET_PATH.write_text(json.dumps(out, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp = MARKET_PATH.with_suffix(".json.tmp")
+    # orjson serialiserer i C og returnerer bytes (utf-8) — ingen str->utf8 re-encode
+    tmp.write_bytes(orjson.dumps(out, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, MARKET_PATH)
     print(f"Wrote {MARKET_PATH}")
 
 